@@ -9,28 +9,64 @@ Flow:
 4. Refresh tokens stored hashed (SHA256) in DB
 """
 
-import json
+import atexit
+import base64
+import hmac
 import os
 import hashlib
 import secrets
+import threading
+import time
 from datetime import datetime, timezone, timedelta
 from typing import Optional
-import psycopg2
-import jwt
+import orjson
+from psycopg_pool import ConnectionPool
 
 
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
 
-def get_db_connection():
-    return psycopg2.connect(os.environ["DATABASE_URL"])
+_db_pool: Optional[ConnectionPool] = None
+_db_pool_lock = threading.Lock()
 
 
-def get_schema() -> str:
-    """Get database schema prefix."""
-    schema = os.environ.get("MAIN_DB_SCHEMA", "public")
-    return f"{schema}." if schema else ""
+def get_db_pool() -> ConnectionPool:
+    """
+    Get connection pool shared across warm invocations.
+    Connections are autocommit: every query is a single atomic statement,
+    so no BEGIN/COMMIT round-trips are spent per request.
+    Hot-path queries use prepare=True, so each pooled connection parses
+    and plans them once.
+    The server may drop the idle connection while the container is frozen,
+    and a failed action cannot simply be retried (login may have committed),
+    so every connection is checked before it is handed out.
+    """
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ConnectionPool(
+                    os.environ["DATABASE_URL"],
+                    min_size=1,
+                    max_size=int(os.environ.get("DB_POOL_MAX", "4")),
+                    max_idle=60,
+                    check=ConnectionPool.check_connection,
+                    kwargs={"autocommit": True},
+                    open=True,
+                )
+    return _db_pool
+
+
+@atexit.register
+def close_db_pool() -> None:
+    if _db_pool is not None:
+        _db_pool.close()
+
+
+# Schema prefix is fixed per container, so all SQL below is built once at import
+_schema = os.environ.get("MAIN_DB_SCHEMA", "public")
+SCHEMA = f"{_schema}." if _schema else ""
 
 
 def get_env(key: str) -> str:
@@ -48,34 +84,80 @@ def hash_token(token: str) -> str:
     return hashlib.sha256(token.encode()).hexdigest()
 
 
+def hash_auth_token(token: str) -> bytes:
+    """Raw SHA256 digest: telegram_auth_tokens.token_hash is BYTEA (32 bytes)."""
+    return hashlib.sha256(token.encode()).digest()
+
+
 def generate_token(length: int = 32) -> str:
     return secrets.token_urlsafe(length)
 
 
-def create_jwt(user_id: int, secret: str, expires_in: int = 900) -> str:
+def b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+JWT_HEADER = b64url(orjson.dumps({"alg": "HS256", "typ": "JWT"}))
+_jwt_key: Optional[bytes] = None
+
+
+def get_jwt_key() -> bytes:
+    """Get JWT signing key, validated once per container."""
+    global _jwt_key
+    if _jwt_key is None:
+        secret = get_env("JWT_SECRET")
+        if len(secret) < 32:
+            raise ValueError("JWT_SECRET must be at least 32 characters")
+        _jwt_key = secret.encode()
+    return _jwt_key
+
+
+def create_jwt(user_id: int, expires_in: int = 900, now: Optional[datetime] = None) -> str:
+    """Create HS256 JWT (same output as PyJWT, without its per-call key handling)."""
+    if now is None:
+        now = datetime.now(timezone.utc)
+    iat = int(now.timestamp())
     payload = {
         "user_id": user_id,
-        "exp": datetime.now(timezone.utc) + timedelta(seconds=expires_in),
-        "iat": datetime.now(timezone.utc),
+        "exp": iat + expires_in,
+        "iat": iat,
     }
-    return jwt.encode(payload, secret, algorithm="HS256")
+    signing_input = JWT_HEADER + b"." + b64url(orjson.dumps(payload))
+    signature = hmac.new(get_jwt_key(), signing_input, hashlib.sha256).digest()
+    return (signing_input + b"." + b64url(signature)).decode()
 
 
 # =============================================================================
 # DATABASE OPERATIONS
 # =============================================================================
 
-def get_auth_token(cursor, token: str) -> Optional[dict]:
-    """Get auth token data by token."""
-    token_hash = hash_token(token)
-    schema = get_schema()
+CLEANUP_INTERVAL = int(os.environ.get("CLEANUP_INTERVAL", "300"))
+CLEANUP_BATCH_SIZE = 4096
+CLEANUP_MAX_BATCHES = 10
+_last_cleanup: Optional[float] = None
 
-    cursor.execute(f"""
-        SELECT telegram_id, telegram_username, telegram_first_name,
-               telegram_last_name, telegram_photo_url, expires_at, used
-        FROM {schema}telegram_auth_tokens
-        WHERE token_hash = %s
-    """, (token_hash,))
+
+def cleanup_due() -> bool:
+    """Check if expired tokens should be purged (at most once per CLEANUP_INTERVAL seconds)."""
+    global _last_cleanup
+    now = time.monotonic()
+    if _last_cleanup is not None and now - _last_cleanup < CLEANUP_INTERVAL:
+        return False
+    _last_cleanup = now
+    return True
+
+
+GET_AUTH_TOKEN_SQL = f"""
+    SELECT telegram_id, telegram_username, telegram_first_name,
+           telegram_last_name, telegram_photo_url, expires_at, used
+    FROM {SCHEMA}telegram_auth_tokens
+    WHERE token_hash = %s
+"""
+
+
+def get_auth_token(cursor, token_hash: bytes) -> Optional[dict]:
+    """Get auth token data by token hash."""
+    cursor.execute(GET_AUTH_TOKEN_SQL, (token_hash,))
 
     row = cursor.fetchone()
     if not row:
@@ -92,93 +174,86 @@ def get_auth_token(cursor, token: str) -> Optional[dict]:
     }
 
 
-def mark_token_used(cursor, token: str) -> bool:
-    """Mark token as used."""
-    token_hash = hash_token(token)
-    schema = get_schema()
+def delete_in_batches(cursor, query: str) -> None:
+    """Run batched DELETE (each batch commits on its own) until the backlog is drained."""
+    for _ in range(CLEANUP_MAX_BATCHES):
+        cursor.execute(query, (CLEANUP_BATCH_SIZE,))
+        if cursor.rowcount < CLEANUP_BATCH_SIZE:
+            break
 
-    cursor.execute(f"""
-        UPDATE {schema}telegram_auth_tokens
-        SET used = TRUE
-        WHERE token_hash = %s AND used = FALSE
-        RETURNING id
-    """, (token_hash,))
 
-    return cursor.fetchone() is not None
+CLEANUP_AUTH_TOKENS_SQL = f"""
+    WITH victims AS (
+        SELECT id FROM {SCHEMA}telegram_auth_tokens
+        WHERE expires_at < NOW() OR (used = TRUE AND created_at < NOW() - INTERVAL '1 hour')
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    DELETE FROM {SCHEMA}telegram_auth_tokens
+    WHERE id IN (SELECT id FROM victims)
+"""
 
 
 def cleanup_expired_tokens(cursor) -> None:
     """Remove expired auth tokens."""
-    schema = get_schema()
-    cursor.execute(f"""
-        DELETE FROM {schema}telegram_auth_tokens
-        WHERE expires_at < NOW() OR (used = TRUE AND created_at < NOW() - INTERVAL '1 hour')
-    """)
-
+    delete_in_batches(cursor, CLEANUP_AUTH_TOKENS_SQL)
 
-def find_user_by_telegram_id(cursor, telegram_id: str) -> Optional[dict]:
-    """Find user by Telegram ID."""
-    schema = get_schema()
-    cursor.execute(f"""
-        SELECT id, email, name, avatar_url, telegram_id
-        FROM {schema}users
-        WHERE telegram_id = %s
-    """, (telegram_id,))
 
-    row = cursor.fetchone()
-    if row:
-        return {
-            "id": row[0],
-            "email": row[1],
-            "name": row[2],
-            "avatar_url": row[3],
-            "telegram_id": row[4],
-        }
-    return None
+# Display name: "first last", else username, else "User <telegram_id>".
+# Upsert requires unique index on users.telegram_id.
+CONSUME_AUTH_TOKEN_SQL = f"""
+    WITH consumed AS (
+        UPDATE {SCHEMA}telegram_auth_tokens
+        SET used = TRUE
+        WHERE token_hash = %s
+          AND used = FALSE
+          AND expires_at > NOW()
+          AND COALESCE(telegram_id, '') <> ''
+        RETURNING telegram_id, telegram_username, telegram_first_name,
+                  telegram_last_name, telegram_photo_url
+    ),
+    upserted AS (
+        INSERT INTO {SCHEMA}users AS u
+            (telegram_id, name, avatar_url, email_verified, password_hash, created_at, updated_at, last_login_at)
+        SELECT telegram_id,
+               COALESCE(
+                   NULLIF(CONCAT_WS(' ', NULLIF(telegram_first_name, ''), NULLIF(telegram_last_name, '')), ''),
+                   NULLIF(telegram_username, ''),
+                   'User ' || telegram_id
+               ),
+               telegram_photo_url, TRUE, '', NOW(), NOW(), NOW()
+        FROM consumed
+        ON CONFLICT (telegram_id) DO UPDATE
+        SET name = COALESCE(EXCLUDED.name, u.name),
+            avatar_url = COALESCE(EXCLUDED.avatar_url, u.avatar_url),
+            last_login_at = NOW(),
+            updated_at = NOW()
+        RETURNING id, email, name, avatar_url, telegram_id
+    ),
+    saved_refresh AS (
+        INSERT INTO {SCHEMA}refresh_tokens (user_id, token_hash, expires_at)
+        SELECT id, %s, %s FROM upserted
+    )
+    SELECT id, email, name, avatar_url, telegram_id FROM upserted
+"""
 
 
-def create_or_update_user(
+def consume_auth_token(
     cursor,
-    telegram_id: str,
-    username: Optional[str],
-    first_name: Optional[str],
-    last_name: Optional[str],
-    photo_url: Optional[str]
-) -> dict:
-    """Create new user or update existing one."""
-    schema = get_schema()
-
-    # Build display name
-    name_parts = []
-    if first_name:
-        name_parts.append(first_name)
-    if last_name:
-        name_parts.append(last_name)
-    display_name = " ".join(name_parts) if name_parts else username or f"User {telegram_id}"
-
-    # Check if user exists
-    existing = find_user_by_telegram_id(cursor, telegram_id)
-
-    if existing:
-        # Update existing user
-        cursor.execute(f"""
-            UPDATE {schema}users
-            SET name = COALESCE(%s, name),
-                avatar_url = COALESCE(%s, avatar_url),
-                last_login_at = NOW(),
-                updated_at = NOW()
-            WHERE telegram_id = %s
-            RETURNING id, email, name, avatar_url, telegram_id
-        """, (display_name, photo_url, telegram_id))
-    else:
-        # Create new user
-        cursor.execute(f"""
-            INSERT INTO {schema}users (telegram_id, name, avatar_url, email_verified, password_hash, created_at, updated_at, last_login_at)
-            VALUES (%s, %s, %s, TRUE, '', NOW(), NOW(), NOW())
-            RETURNING id, email, name, avatar_url, telegram_id
-        """, (telegram_id, display_name, photo_url))
+    token_hash: bytes,
+    refresh_token_hash: str,
+    refresh_expires: datetime
+) -> Optional[dict]:
+    """
+    Mark auth token used, create or update its user and save refresh token
+    in a single round-trip. Returns None if token is not valid for login.
+    """
+    cursor.execute(CONSUME_AUTH_TOKEN_SQL, (token_hash, refresh_token_hash, refresh_expires), prepare=True)
 
     row = cursor.fetchone()
+    if not row:
+        return None
+
     return {
         "id": row[0],
         "email": row[1],
@@ -188,87 +263,86 @@ def create_or_update_user(
     }
 
 
-def save_refresh_token(cursor, user_id: int, token_hash: str, expires_at: datetime) -> None:
-    """Save hashed refresh token to DB."""
-    schema = get_schema()
-    cursor.execute(f"""
-        INSERT INTO {schema}refresh_tokens (user_id, token_hash, expires_at)
-        VALUES (%s, %s, %s)
-    """, (user_id, token_hash, expires_at))
+# Refresh token and its user in one round-trip; LEFT JOIN keeps
+# "token valid but user gone" distinguishable from an invalid token
+FIND_REFRESH_TOKEN_SQL = f"""
+    SELECT r.user_id, r.expires_at, u.id, u.email, u.name, u.avatar_url, u.telegram_id
+    FROM {SCHEMA}refresh_tokens r
+    LEFT JOIN {SCHEMA}users u ON u.id = r.user_id
+    WHERE r.token_hash = %s AND r.expires_at > NOW()
+"""
 
 
 def find_refresh_token(cursor, token_hash: str) -> Optional[dict]:
-    """Find refresh token by hash."""
-    schema = get_schema()
-    cursor.execute(f"""
-        SELECT user_id, expires_at
-        FROM {schema}refresh_tokens
-        WHERE token_hash = %s AND expires_at > NOW()
-    """, (token_hash,))
+    """Find refresh token by hash, together with its user (None if user is missing)."""
+    cursor.execute(FIND_REFRESH_TOKEN_SQL, (token_hash,), prepare=True)
 
     row = cursor.fetchone()
-    if row:
-        return {"user_id": row[0], "expires_at": row[1]}
-    return None
+    if not row:
+        return None
 
+    user = None
+    if row[2] is not None:
+        user = {
+            "id": row[2],
+            "email": row[3],
+            "name": row[4],
+            "avatar_url": row[5],
+            "telegram_id": row[6],
+        }
+    return {"user_id": row[0], "expires_at": row[1], "user": user}
 
-def delete_refresh_token(cursor, token_hash: str) -> None:
-    """Delete refresh token."""
-    schema = get_schema()
-    cursor.execute(f"DELETE FROM {schema}refresh_tokens WHERE token_hash = %s", (token_hash,))
 
+DELETE_REFRESH_TOKEN_SQL = f"DELETE FROM {SCHEMA}refresh_tokens WHERE token_hash = %s"
 
-def get_user_by_id(cursor, user_id: int) -> Optional[dict]:
-    """Get user by ID."""
-    schema = get_schema()
-    cursor.execute(f"""
-        SELECT id, email, name, avatar_url, telegram_id
-        FROM {schema}users WHERE id = %s
-    """, (user_id,))
 
-    row = cursor.fetchone()
-    if row:
-        return {
-            "id": row[0],
-            "email": row[1],
-            "name": row[2],
-            "avatar_url": row[3],
-            "telegram_id": row[4],
-        }
-    return None
+def delete_refresh_token(cursor, token_hash: str) -> None:
+    """Delete refresh token."""
+    cursor.execute(DELETE_REFRESH_TOKEN_SQL, (token_hash,), prepare=True)
+
+
+# refresh_tokens has no documented primary key, so batch by physical row id
+CLEANUP_REFRESH_TOKENS_SQL = f"""
+    DELETE FROM {SCHEMA}refresh_tokens
+    WHERE ctid = ANY(ARRAY(
+        SELECT ctid FROM {SCHEMA}refresh_tokens
+        WHERE expires_at < NOW()
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ))
+"""
 
 
 def cleanup_expired_refresh_tokens(cursor) -> None:
     """Remove expired refresh tokens."""
-    schema = get_schema()
-    cursor.execute(f"DELETE FROM {schema}refresh_tokens WHERE expires_at < NOW()")
+    delete_in_batches(cursor, CLEANUP_REFRESH_TOKENS_SQL)
 
 
 # =============================================================================
 # CORS HELPERS
 # =============================================================================
 
-def get_cors_headers() -> dict:
-    allowed_origins = os.environ.get("ALLOWED_ORIGINS", "*")
-    return {
-        "Access-Control-Allow-Origin": allowed_origins,
-        "Access-Control-Allow-Methods": "POST, OPTIONS",
-        "Access-Control-Allow-Headers": "Content-Type",
-    }
+# Built once per container; responses share these dicts and never mutate them
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": os.environ.get("ALLOWED_ORIGINS", "*"),
+    "Access-Control-Allow-Methods": "POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type",
+}
+JSON_HEADERS = {**CORS_HEADERS, "Content-Type": "application/json"}
 
 
 def cors_response(status: int, body: dict) -> dict:
     return {
         "statusCode": status,
-        "headers": {**get_cors_headers(), "Content-Type": "application/json"},
-        "body": json.dumps(body),
+        "headers": JSON_HEADERS,
+        "body": orjson.dumps(body).decode(),
     }
 
 
 def options_response() -> dict:
     return {
         "statusCode": 204,
-        "headers": get_cors_headers(),
+        "headers": CORS_HEADERS,
         "body": "",
     }
 
@@ -287,7 +361,33 @@ def handle_callback(cursor, body: dict) -> dict:
     if not token:
         return cors_response(400, {"error": "Missing token"})
 
-    token_data = get_auth_token(cursor, token)
+    # Validate JWT secret before the token is consumed
+    get_jwt_key()
+
+    # Generate refresh token up front so login happens in one query
+    refresh_token = generate_token(48)
+    refresh_token_hash = hash_token(refresh_token)
+    now = datetime.now(timezone.utc)
+    refresh_expires = now + timedelta(days=30)
+
+    token_hash = hash_auth_token(token)
+    user = consume_auth_token(cursor, token_hash, refresh_token_hash, refresh_expires)
+    if not user:
+        return auth_token_error(cursor, token_hash)
+
+    access_token = create_jwt(user["id"], now=now)
+
+    return cors_response(200, {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "expires_in": 900,
+        "user": user,
+    })
+
+
+def auth_token_error(cursor, token_hash: bytes) -> dict:
+    """Explain why auth token was rejected (slow path, only on failed login)."""
+    token_data = get_auth_token(cursor, token_hash)
 
     if not token_data:
         return cors_response(404, {"error": "Token not found"})
@@ -301,46 +401,12 @@ def handle_callback(cursor, body: dict) -> dict:
     if expires_at < now:
         return cors_response(410, {"error": "Token expired"})
 
-    # Check if already used
-    if token_data["used"]:
-        return cors_response(410, {"error": "Token already used"})
-
     # Check if user data exists
     if not token_data["telegram_id"]:
         return cors_response(400, {"error": "Token not authenticated"})
 
-    # Get JWT secret
-    jwt_secret = get_env("JWT_SECRET")
-    if len(jwt_secret) < 32:
-        return cors_response(500, {"error": "Server configuration error"})
-
-    # Create or update user
-    user = create_or_update_user(
-        cursor,
-        telegram_id=token_data["telegram_id"],
-        username=token_data["telegram_username"],
-        first_name=token_data["telegram_first_name"],
-        last_name=token_data["telegram_last_name"],
-        photo_url=token_data["telegram_photo_url"],
-    )
-
-    # Mark token as used
-    mark_token_used(cursor, token)
-
-    # Generate tokens
-    access_token = create_jwt(user["id"], jwt_secret)
-    refresh_token = generate_token(48)
-    refresh_token_hash = hash_token(refresh_token)
-    refresh_expires = datetime.now(timezone.utc) + timedelta(days=30)
-
-    save_refresh_token(cursor, user["id"], refresh_token_hash, refresh_expires)
-
-    return cors_response(200, {
-        "access_token": access_token,
-        "refresh_token": refresh_token,
-        "expires_in": 900,
-        "user": user,
-    })
+    # Already used, or consumed concurrently by another request
+    return cors_response(410, {"error": "Token already used"})
 
 
 def handle_refresh(cursor, body: dict) -> dict:
@@ -352,19 +418,19 @@ def handle_refresh(cursor, body: dict) -> dict:
     if not refresh_token:
         return cors_response(400, {"error": "Missing refresh_token"})
 
-    jwt_secret = get_env("JWT_SECRET")
+    get_jwt_key()  # fail on misconfiguration before touching the DB
     token_hash = hash_token(refresh_token)
 
     token_data = find_refresh_token(cursor, token_hash)
     if not token_data:
         return cors_response(401, {"error": "Invalid or expired refresh token"})
 
-    user = get_user_by_id(cursor, token_data["user_id"])
+    user = token_data["user"]
     if not user:
         return cors_response(401, {"error": "User not found"})
 
     # Generate new access token
-    access_token = create_jwt(user["id"], jwt_secret)
+    access_token = create_jwt(user["id"])
 
     return cors_response(200, {
         "access_token": access_token,
@@ -407,39 +473,31 @@ def handler(event, context):
     if method == "POST":
         raw_body = event.get("body", "{}")
         try:
-            body = json.loads(raw_body) if raw_body else {}
-        except json.JSONDecodeError:
+            body = orjson.loads(raw_body) if raw_body else {}
+        except orjson.JSONDecodeError:
             return cors_response(400, {"error": "Invalid JSON"})
 
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Cleanup expired tokens periodically
-        cleanup_expired_tokens(cursor)
-        cleanup_expired_refresh_tokens(cursor)
-
-        # Route to action handler
-        if action == "callback" and method == "POST":
-            response = handle_callback(cursor, body)
-        elif action == "refresh" and method == "POST":
-            response = handle_refresh(cursor, body)
-        elif action == "logout" and method == "POST":
-            response = handle_logout(cursor, body)
-        else:
-            response = cors_response(400, {"error": f"Unknown action: {action}"})
-
-        conn.commit()
-        return response
+        with get_db_pool().connection() as conn:
+            cursor = conn.cursor()
+
+            # Cleanup expired tokens periodically
+            if cleanup_due():
+                cleanup_expired_tokens(cursor)
+                cleanup_expired_refresh_tokens(cursor)
+
+            # Route to action handler
+            if action == "callback" and method == "POST":
+                return handle_callback(cursor, body)
+            elif action == "refresh" and method == "POST":
+                return handle_refresh(cursor, body)
+            elif action == "logout" and method == "POST":
+                return handle_logout(cursor, body)
+            else:
+                return cors_response(400, {"error": f"Unknown action: {action}"})
 
     except ValueError as e:
         return cors_response(500, {"error": "Server configuration error"})
     except Exception as e:
-        if conn:
-            conn.rollback()
         print(f"Error: {e}")
         return cors_response(500, {"error": "Internal server error"})
-    finally:
-        if conn:
-            conn.close()
@@ -7,117 +7,260 @@ Telegram Bot Function
 3. Тестовые сообщения (action=test)
 """
 
-import json
+import atexit
 import os
-import uuid
 import hashlib
-from datetime import datetime, timezone, timedelta
+import hmac
+import random
+import secrets
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime
 from typing import Optional
 
-import psycopg2
-import telebot
+import orjson
+import psycopg
+from psycopg_pool import ConnectionPool, PoolTimeout
+import requests
+from requests.adapters import HTTPAdapter
 
 
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
 
-def get_bot_token() -> str:
-    """Get Telegram bot token."""
-    token = os.environ.get("TELEGRAM_BOT_TOKEN", "")
-    if not token:
-        raise ValueError("TELEGRAM_BOT_TOKEN not configured")
-    return token
+# Environment is fixed for the lifetime of a container: read it once at cold start
+BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "")
+API_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/"
+DEFAULT_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID", "")
+SITE_URL = os.environ.get("SITE_URL", "").rstrip("/")
+WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET", "").encode()
+_schema = os.environ.get("MAIN_DB_SCHEMA", "public")
+SCHEMA = f"{_schema}." if _schema else ""
+
 
+_db_pool: Optional[ConnectionPool] = None
+_db_pool_lock = threading.Lock()
 
-def get_bot() -> telebot.TeleBot:
-    """Create bot instance."""
-    return telebot.TeleBot(get_bot_token())
+# Wait for a free pooled connection well within the webhook's 8 s INSERT budget
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "3"))
 
 
-def get_default_chat_id() -> str:
-    """Get default chat ID for notifications."""
-    return os.environ.get("TELEGRAM_CHAT_ID", "")
+def get_db_pool() -> ConnectionPool:
+    """Get connection pool shared across warm invocations (autocommit connections)."""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ConnectionPool(
+                    os.environ["DATABASE_URL"],
+                    min_size=1,
+                    max_size=int(os.environ.get("DB_POOL_MAX", "3")),
+                    max_idle=60,
+                    timeout=DB_POOL_TIMEOUT,
+                    kwargs={"autocommit": True},
+                    open=True,
+                )
+    return _db_pool
 
 
-def get_schema() -> str:
-    """Get database schema prefix."""
-    schema = os.environ.get("MAIN_DB_SCHEMA", "public")
-    return f"{schema}." if schema else ""
+@atexit.register
+def close_db_pool() -> None:
+    if _db_pool is not None:
+        _db_pool.close()
 
 
 # =============================================================================
 # CORS HELPERS
 # =============================================================================
 
-def get_cors_headers() -> dict:
-    allowed_origins = os.environ.get("ALLOWED_ORIGINS", "*")
-    return {
-        "Access-Control-Allow-Origin": allowed_origins,
-        "Access-Control-Allow-Methods": "POST, OPTIONS",
-        "Access-Control-Allow-Headers": "Content-Type, X-Telegram-Bot-Api-Secret-Token",
-    }
+# Built once per container; responses share these dicts and never mutate them
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": os.environ.get("ALLOWED_ORIGINS", "*"),
+    "Access-Control-Allow-Methods": "POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type, X-Telegram-Bot-Api-Secret-Token",
+}
+JSON_HEADERS = {**CORS_HEADERS, "Content-Type": "application/json"}
 
 
 def cors_response(status: int, body: dict) -> dict:
     return {
         "statusCode": status,
-        "headers": {**get_cors_headers(), "Content-Type": "application/json"},
-        "body": json.dumps(body),
+        "headers": JSON_HEADERS,
+        "body": orjson.dumps(body).decode(),
     }
 
 
-def options_response() -> dict:
-    return {
-        "statusCode": 204,
-        "headers": get_cors_headers(),
-        "body": "",
-    }
+OPTIONS_RESPONSE = {
+    "statusCode": 204,
+    "headers": CORS_HEADERS,
+    "body": "",
+}
+
+
+# =============================================================================
+# TELEGRAM API
+# =============================================================================
+
+# Reused across warm invocations to keep HTTP keep-alive to api.telegram.org.
+# A single host is ever contacted; a few sockets cover concurrent requests.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+# Payloads are serialised with orjson and sent as data=, bypassing requests' json=
+_session.headers["Content-Type"] = "application/json"
+TELEGRAM_TIMEOUT = 10
+
+
+class TelegramApiError(Exception):
+    """Telegram Bot API returned ok=false."""
+
+    def __init__(self, error_code: int, description: str):
+        super().__init__(f"Error code: {error_code}. Description: {description}")
+        self.error_code = error_code
+        self.description = description
+
+
+def telegram_api(method: str, payload: dict) -> dict:
+    """Call Bot API method and return its raw result."""
+    if not BOT_TOKEN:
+        raise ValueError("TELEGRAM_BOT_TOKEN not configured")
+    response = _session.post(
+        API_URL + method,
+        data=orjson.dumps({k: v for k, v in payload.items() if v is not None}),
+        timeout=TELEGRAM_TIMEOUT,
+    )
+    data = orjson.loads(response.content)
+    if not data.get("ok"):
+        raise TelegramApiError(data.get("error_code", response.status_code), data.get("description", ""))
+    return data["result"]
 
 
 # =============================================================================
 # DATABASE OPERATIONS
 # =============================================================================
 
+INSERT_AUTH_TOKEN_SQL = f"""
+    INSERT INTO {SCHEMA}telegram_auth_tokens
+    (token_hash, telegram_id, telegram_username, telegram_first_name,
+     telegram_last_name, expires_at)
+    VALUES (%s, %s, %s, %s, %s, NOW() + INTERVAL '5 minutes')
+"""
+
+# Same INSERT plus a bounded purge of stale tokens, in the same round-trip.
+# Used on a small fraction of logins so the table stays small for free.
+CLEANUP_PROBABILITY = float(os.environ.get("CLEANUP_PROBABILITY", "0.01"))
+INSERT_AUTH_TOKEN_WITH_CLEANUP_SQL = f"""
+    WITH new_token AS ({INSERT_AUTH_TOKEN_SQL})
+    DELETE FROM {SCHEMA}telegram_auth_tokens
+    WHERE id IN (
+        SELECT id FROM {SCHEMA}telegram_auth_tokens
+        WHERE expires_at < NOW() OR (used = TRUE AND created_at < NOW() - INTERVAL '1 hour')
+        LIMIT 1000
+        FOR UPDATE SKIP LOCKED
+    )
+"""
+
+
 def save_auth_token(
+    token: str,
     telegram_id: str,
     username: Optional[str],
     first_name: Optional[str],
     last_name: Optional[str]
-) -> str:
-    """Сохраняет токен авторизации в БД и возвращает его."""
-    token = str(uuid.uuid4())
-    token_hash = hashlib.sha256(token.encode()).hexdigest()
-    schema = get_schema()
+) -> None:
+    """Сохраняет хеш токена авторизации в БД."""
+    token_hash = hashlib.sha256(token.encode()).digest()  # BYTEA column
+    params = (
+        token_hash,
+        telegram_id,
+        username,
+        first_name,
+        last_name,
+    )
 
-    conn = psycopg2.connect(os.environ["DATABASE_URL"])
-    try:
-        cursor = conn.cursor()
-        cursor.execute(f"""
-            INSERT INTO {schema}telegram_auth_tokens
-            (token_hash, telegram_id, telegram_username, telegram_first_name,
-             telegram_last_name, telegram_photo_url, expires_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """, (
-            token_hash,
-            telegram_id,
-            username,
-            first_name,
-            last_name,
-            None,
-            datetime.now(timezone.utc) + timedelta(minutes=5)
-        ))
-        conn.commit()
-    finally:
-        conn.close()
-
-    return token
+    # Single autocommit INSERT: one round-trip, no BEGIN/COMMIT, prepared
+    # once per pooled connection.
+    # The server may drop an idle pooled connection while the container is
+    # frozen; the pool discards it on return, so retry once on a fresh one.
+    # PoolTimeout (pool exhausted or DB unreachable) is not a stale
+    # connection: retrying would only double the wait.
+    if random.random() < CLEANUP_PROBABILITY:
+        query = INSERT_AUTH_TOKEN_WITH_CLEANUP_SQL
+    else:
+        query = INSERT_AUTH_TOKEN_SQL
+
+    for attempt in range(2):
+        try:
+            with get_db_pool().connection() as conn:
+                conn.cursor().execute(query, params, prepare=True)
+            break
+        except PoolTimeout:
+            raise
+        except psycopg.OperationalError:
+            if attempt:
+                raise
 
 
 # =============================================================================
 # WEBHOOK HANDLERS (Authorization)
 # =============================================================================
 
+# Telegram only needs a 2xx; the acknowledgement body never changes
+OK_BODY = orjson.dumps({"ok": True}).decode()
+
+WEB_AUTH_TEXT = "Авторизация готова!\n\nНажмите кнопку ниже, чтобы войти на сайт 👇\n\nСсылка действительна 5 минут."
+START_TEXT = "Привет! Используйте кнопку «Войти через Telegram» на сайте."
+AUTH_FAILED_TEXT = "Не удалось подготовить вход, попробуйте ещё раз: /start web_auth"
+
+# Runs the token INSERT and the outgoing Telegram request concurrently
+_executor = ThreadPoolExecutor(max_workers=4)
+atexit.register(_executor.shutdown)
+
+# How long the webhook waits for sendMessage before acknowledging Telegram.
+# Defaults to the full HTTP timeout: the runtime may freeze the container once
+# the handler returns, and Telegram will not re-deliver an acknowledged update.
+# Lower it to acknowledge early at the risk of losing a slow message.
+# The INSERT is always awaited.
+SEND_WAIT_TIMEOUT = float(os.environ.get("SEND_WAIT_TIMEOUT", str(TELEGRAM_TIMEOUT)))
+
+# update_id values already handled by this container. Telegram re-delivers
+# an update when the webhook response is slow or fails.
+SEEN_UPDATES_MAX = 4096
+_seen_updates: "OrderedDict[int, None]" = OrderedDict()
+
+
+def log_late_send(future) -> None:
+    """Report a sendMessage that failed after the webhook stopped waiting."""
+    error = future.exception()
+    if error is not None:
+        print(f"Late sendMessage failed: {error}")
+
+
+def is_duplicate_update(update_id: Optional[int]) -> bool:
+    """Remember update_id; return True if it was already processed."""
+    if update_id is None:
+        return False
+    if update_id in _seen_updates:
+        return True
+    _seen_updates[update_id] = None
+    if len(_seen_updates) > SEEN_UPDATES_MAX:
+        _seen_updates.popitem(last=False)
+    return False
+
+
+def retract_login_button(chat_id: int, sent) -> None:
+    """Remove the inline login button from an already sent auth message."""
+    try:
+        message = sent.result(timeout=SEND_WAIT_TIMEOUT)
+        telegram_api("editMessageReplyMarkup", {
+            "chat_id": chat_id,
+            "message_id": message["message_id"],
+        })
+    except Exception as e:
+        print(f"Could not remove login button: {e}")
+
+
 def handle_web_auth(chat_id: int, user: dict) -> None:
     """Обработка команды /start web_auth."""
     telegram_id = str(user.get("id", ""))
@@ -125,54 +268,75 @@ def handle_web_auth(chat_id: int, user: dict) -> None:
     first_name = user.get("first_name")
     last_name = user.get("last_name")
 
-    token = save_auth_token(telegram_id, username, first_name, last_name)
+    if not SITE_URL:
+        raise ValueError("SITE_URL not configured")
 
-    site_url = os.environ["SITE_URL"].rstrip("/")
-    auth_url = f"{site_url}/auth/telegram/callback?token={token}"
+    # Token is generated locally, so the DB write and the message are
+    # independent: run them concurrently, but never return before the
+    # INSERT has finished.
+    token = secrets.token_urlsafe(32)
+    saved = _executor.submit(save_auth_token, token, telegram_id, username, first_name, last_name)
 
-    bot = get_bot()
-    bot.send_message(
-        chat_id,
-        f"Авторизация готова!\n\nНажмите кнопку ниже, чтобы войти на сайт 👇\n\nСсылка действительна 5 минут.",
-        reply_markup=telebot.types.InlineKeyboardMarkup().add(
-            telebot.types.InlineKeyboardButton("Войти на сайт", url=auth_url)
-        )
-    )
+    auth_url = f"{SITE_URL}/auth/telegram/callback?token={token}"
+    sent = _executor.submit(telegram_api, "sendMessage", {
+        "chat_id": chat_id,
+        "text": WEB_AUTH_TEXT,
+        "reply_markup": {"inline_keyboard": [[{"text": "Войти на сайт", "url": auth_url}]]},
+    })
+
+    try:
+        saved.result(timeout=8)
+    except Exception as e:
+        # The button may already be delivered, but its link would only lead
+        # to "Token not found": take the button back and explain.
+        print(f"Error saving auth token: {e}")
+        retract_login_button(chat_id, sent)
+        telegram_api("sendMessage", {"chat_id": chat_id, "text": AUTH_FAILED_TEXT})
+        return
+
+    try:
+        sent.result(timeout=SEND_WAIT_TIMEOUT)
+    except FutureTimeoutError:
+        print("sendMessage still in progress, acknowledging webhook")
+        sent.add_done_callback(log_late_send)
 
 
 def handle_start(chat_id: int) -> None:
     """Обработка команды /start без параметров."""
-    bot = get_bot()
-    bot.send_message(chat_id, "Привет! Используйте кнопку «Войти через Telegram» на сайте.")
+    telegram_api("sendMessage", {
+        "chat_id": chat_id,
+        "text": START_TEXT,
+    })
 
 
 def process_webhook(body: dict) -> dict:
     """Обработка webhook от Telegram."""
+    if is_duplicate_update(body.get("update_id")):
+        return {"statusCode": 200, "body": OK_BODY}
+
     message = body.get("message")
 
     if not message:
-        return {"statusCode": 200, "body": json.dumps({"ok": True})}
+        return {"statusCode": 200, "body": OK_BODY}
 
     text = message.get("text", "")
     user = message.get("from", {})
     chat_id = message.get("chat", {}).get("id")
 
     if not chat_id:
-        return {"statusCode": 200, "body": json.dumps({"ok": True})}
+        return {"statusCode": 200, "body": OK_BODY}
 
     try:
-        if text.startswith("/start"):
-            parts = text.split(" ", 1)
-            if len(parts) > 1 and parts[1] == "web_auth":
-                handle_web_auth(chat_id, user)
-            else:
-                handle_start(chat_id)
-    except telebot.apihelper.ApiTelegramException as e:
+        if text == "/start web_auth":
+            handle_web_auth(chat_id, user)
+        elif text.startswith("/start"):
+            handle_start(chat_id)
+    except TelegramApiError as e:
         print(f"Telegram API error: {e}")
     except Exception as e:
         print(f"Error processing webhook: {e}")
 
-    return {"statusCode": 200, "body": json.dumps({"ok": True})}
+    return {"statusCode": 200, "body": OK_BODY}
 
 
 # =============================================================================
@@ -185,7 +349,7 @@ def handle_send(body: dict) -> dict:
     Send text message.
     """
     text = body.get("text", "").strip()
-    chat_id = body.get("chat_id") or get_default_chat_id()
+    chat_id = body.get("chat_id") or DEFAULT_CHAT_ID
     parse_mode = body.get("parse_mode", "HTML")
     silent = body.get("silent", False)
 
@@ -199,19 +363,18 @@ def handle_send(body: dict) -> dict:
         return cors_response(400, {"error": "Message too long (max 4096 characters)"})
 
     try:
-        bot = get_bot()
-        result = bot.send_message(
-            chat_id=chat_id,
-            text=text,
-            parse_mode=parse_mode,
-            disable_notification=silent,
-            disable_web_page_preview=True,
-        )
+        result = telegram_api("sendMessage", {
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": parse_mode,
+            "disable_notification": silent,
+            "disable_web_page_preview": True,
+        })
         return cors_response(200, {
             "success": True,
-            "message_id": result.message_id,
+            "message_id": result["message_id"],
         })
-    except telebot.apihelper.ApiTelegramException as e:
+    except TelegramApiError as e:
         return cors_response(400, {
             "error": e.description,
             "error_code": e.error_code,
@@ -227,7 +390,7 @@ def handle_send_photo(body: dict) -> dict:
     """
     photo_url = body.get("photo_url", "").strip()
     caption = body.get("caption", "").strip()
-    chat_id = body.get("chat_id") or get_default_chat_id()
+    chat_id = body.get("chat_id") or DEFAULT_CHAT_ID
     parse_mode = body.get("parse_mode", "HTML")
 
     if not photo_url:
@@ -237,18 +400,17 @@ def handle_send_photo(body: dict) -> dict:
         return cors_response(400, {"error": "chat_id is required"})
 
     try:
-        bot = get_bot()
-        result = bot.send_photo(
-            chat_id=chat_id,
-            photo=photo_url,
-            caption=caption if caption else None,
-            parse_mode=parse_mode,
-        )
+        result = telegram_api("sendPhoto", {
+            "chat_id": chat_id,
+            "photo": photo_url,
+            "caption": caption if caption else None,
+            "parse_mode": parse_mode,
+        })
         return cors_response(200, {
             "success": True,
-            "message_id": result.message_id,
+            "message_id": result["message_id"],
         })
-    except telebot.apihelper.ApiTelegramException as e:
+    except TelegramApiError as e:
         return cors_response(400, {
             "error": e.description,
             "error_code": e.error_code,
@@ -262,7 +424,7 @@ def handle_test(body: dict) -> dict:
     POST ?action=test
     Send test message to verify configuration.
     """
-    chat_id = body.get("chat_id") or get_default_chat_id()
+    chat_id = body.get("chat_id") or DEFAULT_CHAT_ID
 
     if not chat_id:
         return cors_response(400, {"error": "chat_id is required"})
@@ -274,18 +436,17 @@ def handle_test(body: dict) -> dict:
 <i>Время: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}</i>"""
 
     try:
-        bot = get_bot()
-        result = bot.send_message(
-            chat_id=chat_id,
-            text=text,
-            parse_mode="HTML",
-        )
+        result = telegram_api("sendMessage", {
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": "HTML",
+        })
         return cors_response(200, {
             "success": True,
             "message": "Test message sent",
-            "message_id": result.message_id,
+            "message_id": result["message_id"],
         })
-    except telebot.apihelper.ApiTelegramException as e:
+    except TelegramApiError as e:
         return cors_response(400, {
             "error": e.description,
             "error_code": e.error_code,
@@ -298,13 +459,14 @@ def handle_test(body: dict) -> dict:
 # MAIN HANDLER
 # =============================================================================
 
-def handler(event: dict, context) -> dict:
-    """Main entry point."""
-    method = event.get("httpMethod", "POST")
+def handle_options(event: dict) -> dict:
+    """CORS preflight: constant response, no parsing or env access."""
+    return OPTIONS_RESPONSE
 
-    if method == "OPTIONS":
-        return options_response()
 
+def handle_request(event: dict) -> dict:
+    """Notification API (?action=...) or Telegram webhook."""
+    method = event.get("httpMethod", "POST")
     params = event.get("queryStringParameters") or {}
     action = params.get("action", "")
 
@@ -314,8 +476,8 @@ def handler(event: dict, context) -> dict:
         if method == "POST":
             raw_body = event.get("body", "{}")
             try:
-                body = json.loads(raw_body) if raw_body else {}
-            except json.JSONDecodeError:
+                body = orjson.loads(raw_body) if raw_body else {}
+            except orjson.JSONDecodeError:
                 return cors_response(400, {"error": "Invalid JSON"})
 
         if action == "send" and method == "POST":
@@ -328,14 +490,50 @@ def handler(event: dict, context) -> dict:
             return cors_response(400, {"error": f"Unknown action: {action}"})
 
     # No action — handle Telegram webhook
-    headers = event.get("headers", {})
-    headers_lower = {k.lower(): v for k, v in headers.items()}
-    webhook_secret = os.environ.get("TELEGRAM_WEBHOOK_SECRET")
+    return handle_webhook(event)
 
-    if webhook_secret:
-        request_secret = headers_lower.get("x-telegram-bot-api-secret-token", "")
-        if request_secret != webhook_secret:
-            return {"statusCode": 401, "body": json.dumps({"error": "Unauthorized"})}
 
-    body = json.loads(event.get("body", "{}"))
+def get_header(headers: dict, name: str) -> Optional[str]:
+    """
+    Case-insensitive header lookup. Gateways send either canonical or
+    lower-case names, so try both directly and scan only as a fallback.
+    """
+    value = headers.get(name)
+    if value is None:
+        name_lower = name.lower()
+        value = headers.get(name_lower)
+        if value is None:
+            value = next((v for k, v in headers.items() if k.lower() == name_lower), None)
+    return value
+
+
+def handle_webhook(event: dict) -> dict:
+    """Verify webhook secret and process Telegram update."""
+    if WEBHOOK_SECRET:
+        headers = event.get("headers") or {}
+        request_secret = get_header(headers, "X-Telegram-Bot-Api-Secret-Token") or ""
+        if not hmac.compare_digest(request_secret.encode(), WEBHOOK_SECRET):
+            return {"statusCode": 401, "body": orjson.dumps({"error": "Unauthorized"}).decode()}
+
+    raw_body = event.get("body")
+    if not raw_body:
+        return {"statusCode": 200, "body": OK_BODY}
+    try:
+        body = orjson.loads(raw_body)
+    except orjson.JSONDecodeError:
+        return {"statusCode": 400, "body": orjson.dumps({"error": "Invalid JSON"}).decode()}
+    if not isinstance(body, dict):
+        return {"statusCode": 400, "body": orjson.dumps({"error": "Invalid JSON"}).decode()}
+
     return process_webhook(body)
+
+
+METHOD_HANDLERS = {
+    "OPTIONS": handle_options,
+    "POST": handle_request,
+}
+
+
+def handler(event: dict, context) -> dict:
+    """Main entry point."""
+    return METHOD_HANDLERS.get(event.get("httpMethod", "POST"), handle_request)(event)